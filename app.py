@@ -1,117 +1,296 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import re
 import gspread
 import time
 import datetime
 import requests
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from oauth2client.service_account import ServiceAccountCredentials
+from google import genai
+from google.genai import types
 
 # --- 1. CONFIGURATIE & HELPER FUNCTIES ---
 
+# Aantal Gemini-batches dat tegelijk wordt verstuurd (blijft onder de 20 verbindingen van de HTTP-pool)
+MAX_WORKERS = 10
+
+# Model voor de (goedkopere, asynchrone) Gemini Batch Mode
+BATCH_MODEL = "gemini-2.5-flash"
+
+# Map waarin Gemini-antwoorden per (model, prompt) bewaard worden, en hoe lang (seconden) ze geldig blijven
+GEMINI_CACHE_DIR = Path(".cache/gemini")
+GEMINI_CACHE_TTL = 7 * 24 * 3600
+
+# Woorden die uit de ingrediëntenlijsten gefilterd worden
+DIFFICULT_WORDS = ["edelgist", "gistvlokken", "gistextract", "gist", "sheaboter", "shea", "palmvet", "palmolie", "ingredienten:", "ca", "gedroogd", "gepasteuriseerd"]
+
+# Regexes voor sanitize(), eenmalig gecompileerd (alle moeilijke woorden in één alternatie)
+DIFFICULT_RE = re.compile(r"\b(?:" + "|".join(re.escape(w) for w in DIFFICULT_WORDS) + r")\b", re.IGNORECASE)
+SPOREN_RE = re.compile(r"\bsporen\b|kan.*bevatten", re.IGNORECASE)
+PCT_RE = re.compile(r"\d+(?:[\.,]\d+)?\s*%")
+BRACKET_RE = re.compile(r"[\(\{\[](.*?)[\)\}\]]")
+# Leestekens en (reeksen) witruimte in één scan naar één spatie; haakjes vallen er bewust buiten
+SEPARATOR_RE = re.compile(r"[;,:.\s]+")
+
+# Parsers voor de Gemini-antwoorden: één regex-pass per regel
+# Stap 2: "ID: ROL, TYPE" (het eerste getal in de regel is de ID)
+# Elke vorm van "(niet) relevant" ("niet-relevant", "Niet relevant" zonder aparte rol, "Relevant: nee") wordt "Niet relevant"
+# Plantaardig/dierlijk zonder woordgrens aan het eind, zodat ook verbogen vormen ("plantaardige oorsprong") tellen
+CLASSIFIER_RESP_RE = re.compile(r"^\D*(\d+).*?\b(wel|niet)\b.*?\b(plantaardig|dierlijk|niet[\s-]*relevant\b|relevant\b)", re.IGNORECASE)
+# Stap 3: "ID:<ID> | oordeel:<oordeel> | rationale:<uitleg>" (rationale is optioneel)
+PRODUCT_RESP_RE = re.compile(r"oordeel\s*[:：]\s*([A-Za-zÀ-ÿ]+)(?:.*?rationale\s*[:：]\s*(.+))?", re.IGNORECASE)
+
+# Hoe lang (seconden) de Google-verbinding hergebruikt wordt; ruim binnen het uur dat een token geldig is
+CLIENT_TTL = 3000
+
+# Hoe lang (seconden) ingelezen tabbladen binnen een sessie hergebruikt worden (alleen voor stappen die niets terugschrijven)
+SHEET_CACHE_TTL = 60
+
+# Gedeelde HTTP-sessie, zodat TCP/TLS-verbindingen hergebruikt worden (keep-alive)
+# Rate limits (429) en serverfouten worden automatisch opnieuw geprobeerd, met respect voor Retry-After
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=20, pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=None, raise_on_status=False)
+))
+
+@st.cache_resource(ttl=CLIENT_TTL, show_spinner=False)
 def get_google_sheet_client():
-    """Haalt credentials uit Streamlit Secrets."""
+    """Haalt credentials uit Streamlit Secrets (eenmalig, daarna uit de cache)."""
     try:
         creds_dict = st.secrets["gcp_service_account"]
         scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        return gspread.authorize(creds)
+        # 429's en serverfouten van Google worden met exponentiële backoff opnieuw geprobeerd
+        return gspread.authorize(creds, http_client=gspread.BackOffHTTPClient)
     except Exception as e:
         st.error(f"Sleutel-fout: Zorg dat gcp_service_account in je secrets staat. Error: {e}")
         return None
 
+@st.cache_resource(ttl=CLIENT_TTL, show_spinner=False)
+def open_sheet():
+    """Opent de spreadsheet eenmalig; None als er geen verbinding is."""
+    client = get_google_sheet_client()
+    if client is None:
+        return None
+    return client.open("Eiweet validatie met AI")
+
+@st.cache_data(show_spinner=False)
 def get_gemini_key():
     return st.secrets["GEMINI_API_KEY"]
 
-def call_gemini(prompt, model="gemini-2.0-flash-lite"):
-    """Universele helper om de Gemini API aan te roepen."""
+def call_gemini(prompt, model="gemini-2.0-flash-lite", expect=None, force_refresh=False):
+    """Universele helper om de Gemini API aan te roepen; force_refresh slaat beide caches over (voor een nieuwe poging)."""
+    if force_refresh:
+        return request_gemini(prompt, model, expect, force_refresh=True)
+    return cached_gemini(prompt, model, expect)
+
+@st.cache_data(ttl=86400, max_entries=10000, show_spinner=False)
+def cached_gemini(prompt, model, expect):
+    """In-memory cache bovenop de schijf-cache."""
+    # Een ValueError (onbruikbaar antwoord) wordt door st.cache_data niet onthouden
+    return request_gemini(prompt, model, expect)
+
+def request_gemini(prompt, model="gemini-2.0-flash-lite", expect=None, force_refresh=False):
+    """Vraagt Gemini om een antwoord (met schijf-cache); force_refresh slaat de cache over."""
+    key = hashlib.blake2b(f"{model}|{prompt}".encode(), digest_size=16).hexdigest()
+    cache_path = GEMINI_CACHE_DIR / f"{key}.json"
+    if not force_refresh and cache_path.exists() and time.time() - cache_path.stat().st_mtime < GEMINI_CACHE_TTL:
+        return json.loads(cache_path.read_text(encoding="utf-8"))['text']
+
     API_KEY = get_gemini_key()
     url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={API_KEY}"
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
         "generationConfig": {"temperature": 0.1}
     }
-    response = requests.post(url, json=payload, timeout=15)
+    response = http_session.post(url, json=payload, timeout=30)
     response.raise_for_status()
-    return response.json()['candidates'][0]['content']['parts'][0]['text'].strip()
+    text = response.json()['candidates'][0]['content']['parts'][0]['text'].strip()
+    # Geen enkele regel past op expect: niet bewaren, zodat een volgende poging het opnieuw vraagt
+    if expect is not None and not any(expect.search(line.strip()) for line in text.splitlines()):
+        raise ValueError(f"Geen bruikbare regels in het Gemini-antwoord: {text[:200]!r}")
+    GEMINI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(json.dumps({'model': model, 'text': text}), encoding="utf-8")
+    return text
+
+def smart_brackets(match):
+    """Haakjes met een opsomming (komma) weghalen, overige haakjes laten staan."""
+    content = match.group(1) # De tekst tussen de haakjes
+    # Als er een komma in de tekst staat, is het een opsomming
+    if "," in content:
+        return " " + content + " " # Haakjes weg, inhoud blijft
+    else:
+        return f"({content})" # Laat staan (of gebruik match.group(0))
+
+def sanitize(ingredienten):
+    """Schoont een hele kolom ingrediëntenlijsten in één keer op (gevectoriseerd)."""
+    texts = ingredienten.fillna("").astype(str)
+
+    # Veel producten delen dezelfde ingrediëntenlijst: alleen unieke, niet-lege teksten opschonen
+    unique = texts[texts != ""].drop_duplicates()
+
+    # 1. Basis opschoning
+    s = unique.str.split("Ingrediënten:", n=1).str[-1]
+    s = s.str.split(SPOREN_RE, n=1, regex=True).str[0]
+    s = s.str.replace(DIFFICULT_RE, "", regex=True)
+    s = s.str.replace(PCT_RE, "", regex=True)
+
+    # 2. SLIMME HAAKJES LOGICA: alleen deze stap heeft een Python-callback per match
+    s = s.str.replace(BRACKET_RE, smart_brackets, regex=True)
+
+    # 3. Overige leestekens en dubbele spaties weg (haakjes blijven staan) en afronding
+    s = s.str.replace(SEPARATOR_RE, " ", regex=True).str.strip()
+
+    # Resultaat terug mappen naar alle rijen; lege invoer blijft ""
+    mapping = pd.Series(s.to_numpy(), index=unique.to_numpy())
+    return texts.map(mapping).fillna("")
+
+def submit_gemini_batch(stage, prompts, batches):
+    """Zet alle prompts als één Gemini Batch-job klaar en onthoudt de job in de sessie."""
+    client = genai.Client(api_key=get_gemini_key())
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as f:
+        for n, prompt in enumerate(prompts):
+            request = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"temperature": 0.1}}
+            f.write(json.dumps({"key": f"batch_{n}", "request": request}) + "\n")
+    try:
+        uploaded = client.files.upload(file=f.name, config=types.UploadFileConfig(display_name=f"eiweet-{stage}", mime_type="jsonl"))
+    finally:
+        Path(f.name).unlink(missing_ok=True)
+    job = client.batches.create(model=BATCH_MODEL, src=uploaded.name, config={"display_name": f"eiweet-{stage}"})
+    st.session_state.setdefault("batch_jobs", {})[stage] = {"name": job.name, "batches": batches}
+    return job.name
+
+def fetch_gemini_batch(stage):
+    """Haalt de status van een Batch-job op, plus de antwoorden ({key: tekst}) als de job klaar is."""
+    client = genai.Client(api_key=get_gemini_key())
+    job = client.batches.get(name=st.session_state["batch_jobs"][stage]["name"])
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        return job.state.name, None
+    content = client.files.download(file=job.dest.file_name).decode("utf-8")
+    texts = {}
+    for line in content.splitlines():
+        if not line.strip(): continue
+        item = json.loads(line)
+        # Mislukte of geblokkeerde requests (geen 'response', geen candidates of parts) overslaan; die batches gaan later alsnog live
+        try:
+            texts[item["key"]] = item["response"]['candidates'][0]['content']['parts'][0]['text'].strip()
+        except (KeyError, IndexError, TypeError):
+            continue
+    return job.state.name, texts
+
+def apply_updates(df, updates):
+    """Schrijft verzamelde {kolom: {idx: waarde}} in één toewijzing per kolom naar het DataFrame."""
+    for col, values in updates.items():
+        if values:
+            df.loc[list(values), col] = pd.Series(values)
+
+def df_to_rows(df):
+    """Zet een DataFrame om naar rijen (met kopregel) voor de Sheets API; lege waarden worden ""."""
+    # Eén pass, zonder tussentijdse kopie van het DataFrame zoals bij fillna()/where()
+    return [df.columns.tolist()] + df.to_numpy(dtype=object, na_value="").tolist()
+
+def sheet_payload(title, df, min_rows=1):
+    """Bouwt één 'data'-item voor values_batch_update vanuit een DataFrame (exact bereik vanaf A1, aangevuld tot min_rows)."""
+    values = df_to_rows(df)
+    # Lege rijen tot min_rows, zodat daar geen oude waarden blijven staan
+    values += [[""] * len(values[0]) for _ in range(min_rows - len(values))]
+    end_a1 = gspread.utils.rowcol_to_a1(len(values), len(values[0]))
+    return {'range': gspread.utils.absolute_range_name(title, f"A1:{end_a1}"), 'values': values}
+
+def save_df(sheet, df):
+    """Schrijft het volledige DataFrame in één API-call naar het tabblad (plus een resize als de grootte verandert)."""
+    rows, cols = max(len(df) + 1, 2), len(df.columns)
+    # Raster exact passend maken: oude rijen en kolommen buiten de data verdwijnen, zodat een clear() niet nodig is
+    # (minimaal 2 rijen, want een tabblad met een bevroren kopregel kan niet kleiner)
+    if sheet.row_count != rows or sheet.col_count != cols:
+        sheet.resize(rows=rows, cols=cols)
+    # Een lege rij 2 (DataFrame zonder rijen) wordt ook overschreven
+    payload = sheet_payload(sheet.title, df, min_rows=rows)
+    sheet.spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': [payload]})
+    # Gecachete versie van dit tabblad is nu verouderd
+    st.session_state.get("sheet_cache", {}).pop(sheet.title, None)
+
+def save_cells(sheet, df, indices, columns):
+    """Schrijft alleen de opgegeven rijen en kolommen terug naar het tabblad (checkpoint), in één API-call."""
+    # DataFrame-index 0 hoort bij rij 2 van het tabblad (rij 1 is de kopregel)
+    # Kolommen die (nog) niet bestaan of buiten het raster vallen komen pas mee bij de volledige opslag
+    col_nums = {col: df.columns.get_loc(col) + 1 for col in columns if col in df.columns}
+    col_nums = {col: num for col, num in col_nums.items() if num <= sheet.col_count}
+    cells = [
+        gspread.Cell(row=idx + 2, col=num, value="" if pd.isna(df.at[idx, col]) else df.at[idx, col])
+        for idx in sorted(indices) for col, num in col_nums.items()
+    ]
+    if cells:
+        sheet.update_cells(cells, value_input_option='RAW')
+    st.session_state.get("sheet_cache", {}).pop(sheet.title, None)
+
+def read_sheets(spreadsheet, titles, use_cache=False):
+    """Leest meerdere tabbladen in één API-call in als DataFrames (use_cache: kort hergebruiken binnen de sessie)."""
+    # Standaard altijd vers: stappen die een heel tabblad terugschrijven mogen geen verouderde kopie gebruiken
+    cache = st.session_state.setdefault("sheet_cache", {})
+    now = time.time()
+    missing = [t for t in titles if not use_cache or t not in cache or now - cache[t][0] > SHEET_CACHE_TTL]
+    if missing:
+        resp = spreadsheet.values_batch_get(ranges=[gspread.utils.absolute_range_name(t) for t in missing])
+        for title, value_range in zip(missing, resp['valueRanges']):
+            rows = value_range.get('values', [])
+            header = rows[0] if rows else []
+            # Net als get_all_records(): korte rijen aanvullen en getallen omzetten
+            records = [gspread.utils.numericise_all((r + [""] * len(header))[:len(header)]) for r in rows[1:]]
+            cache[title] = (now, pd.DataFrame(records, columns=header))
+    return [cache[t][1].copy() for t in titles]
 
 # --- 2. DE 6 HOOFDFUNCTIES (Scripts) ---
 
 def run_prep_ingredients():
     """Stap 1: Opschonen en Masterlijst aanvullen met rapportage"""
-    client = get_google_sheet_client()
+    spreadsheet = open_sheet()
     
-    # Veiligheidscheck: als de verbinding faalt, stop de functie
-    if client is None:
+    # Veiligheidscheck: als de verbinding faalt, stop de functie (en probeer het de volgende keer opnieuw)
+    if spreadsheet is None:
+        st.cache_resource.clear()
         st.error("❌ Kan geen verbinding maken met Google Sheets. Controleer je secrets.toml!")
         return
 
     with st.status("Stap 1: Ingrediënten voorbereiden...") as status:
         st.write("🔄 Data inladen uit Google Sheets...")
-        spreadsheet = client.open("Eiweet validatie met AI")
         sheet_master = spreadsheet.worksheet("Ingredienten Database")
         sheet_products = spreadsheet.worksheet("Producten Input")
         
-        df_master = pd.DataFrame(sheet_master.get_all_records())
-        df_products = pd.DataFrame(sheet_products.get_all_records())
-
-        difficult_words = ["edelgist", "gistvlokken", "gistextract", "gist", "sheaboter", "shea", "palmvet", "palmolie", "ingredienten:", "ca", "gedroogd", "gepasteuriseerd"]
-
-        def sanitize(ingr):
-            if not isinstance(ingr, str) or ingr == "": return ""
-            
-            # 1. Basis opschoning
-            if "Ingrediënten:" in ingr: 
-                ingr = ingr.split("Ingrediënten:", 1)[1]
-            
-            sanitized = re.split(r"\bsporen\b|kan.*bevatten", ingr, flags=re.IGNORECASE)[0]
-            
-            for word in difficult_words:
-                sanitized = re.sub(rf"\b{re.escape(word)}\b", "", sanitized, flags=re.IGNORECASE)
-            
-            sanitized = re.sub(r"\d+([\.,]\d+)?\s*%", "", sanitized)
-
-            # 2. SLIMME HAAKJES LOGICA
-            def smart_brackets(match):
-                content = match.group(1) # De tekst tussen de haakjes
-                # Als er een komma in de tekst staat, is het een opsomming
-                if "," in content:
-                    return " " + content + " " # Haakjes weg, inhoud blijft
-                else:
-                    return f"({content})" # Laat staan (of gebruik match.group(0))
-
-            # Pas dit toe op (), [], <> en {}
-            # De regex r"[\(\{\[\<] (.*?) [\)\}\]\>]" zoekt tekst tussen alle soorten haakjes
-            sanitized = re.sub(r"[\(\{\[](.*?)[\)\}\]]", smart_brackets, sanitized)
-
-            # 3. Verwijder overige leestekens (behalve de haakjes die we wilden laten staan)
-            # We verwijderen nu puntkomma's, punten, etc. maar laten letters/cijfers en haakjes met rust
-            sanitized = re.sub(r"[;,:\.]", " ", sanitized)
-            
-            # 4. Dubbele spaties en afronding
-            return re.sub(r"\s{2,}", " ", sanitized).strip()
+        df_master, df_products = read_sheets(spreadsheet, ["Ingredienten Database", "Producten Input"])
 
         st.write("🧹 Ingrediëntenlijsten opschonen...")
-        df_products['Ingredients clean'] = df_products['Ingredienten'].apply(sanitize)
+        df_products['Ingredients clean'] = sanitize(df_products['Ingredienten'])
         
         # Sla opgeschoonde data op in de Producten sheet
-        df_save_products = df_products[df_products['Productnaam'].astype(str).str.strip() != ""].copy()
-        sheet_products.clear()
-        sheet_products.update(values=[df_save_products.columns.tolist()] + df_save_products.where(pd.notnull(df_save_products), None).values.tolist(), range_name='A1')
+        df_save_products = df_products[df_products['Productnaam'].astype(str).str.strip() != ""].reset_index(drop=True)
+        save_df(sheet_products, df_save_products)
         
         # --- Masterlijst aanvullen ---
         st.write("🔍 Zoeken naar nieuwe ingrediënten voor de masterlijst...")
-        def get_list(text):
-            return [x.strip() for x in text.split(" ") if len(x.strip()) > 2]
-        
-        df_products['Ingr_List'] = df_products['Ingredients clean'].apply(get_list)
-        df_extracted = df_products[['Productnaam', 'Ingr_List']].explode('Ingr_List').dropna()
+        # Eén rij per (product, ingrediënt); korte woorden (<= 2 tekens) tellen niet mee
+        ingr_lists = df_products['Ingredients clean'].fillna("").str.split()
+        df_extracted = df_products[['Productnaam']].assign(Ingr_List=ingr_lists).explode('Ingr_List')
+        df_extracted = df_extracted[df_extracted['Ingr_List'].str.len() > 2]
         
         # Vergelijken met bestaande masterlijst (alles in lowercase voor de check)
         df_master['tmp'] = df_master['Ingredient'].astype(str).str.lower().str.strip()
         df_extracted['tmp'] = df_extracted['Ingr_List'].astype(str).str.lower().str.strip()
         
-        new_items = df_extracted[~df_extracted['tmp'].isin(df_master['tmp'])].drop_duplicates('tmp')
+        # Alleen ingrediënten die nog niet in de masterlijst staan (eerste bronproduct per ingrediënt)
+        first_source = df_extracted.drop_duplicates('tmp').set_index('tmp')
+        new_tokens = first_source.index.difference(df_master['tmp'].unique(), sort=False)
+        new_items = first_source.loc[new_tokens].reset_index()
         num_new = len(new_items)
 
         if num_new > 0:
@@ -122,17 +301,24 @@ def run_prep_ingredients():
                 'Bron product': new_items['Productnaam']
             })
             df_final_master = pd.concat([df_master, new_rows], ignore_index=True).drop(columns=['tmp'])
-            sheet_master.clear()
-            sheet_master.update(values=[df_final_master.columns.tolist()] + df_final_master.fillna("").values.tolist(), range_name='A1')
+            save_df(sheet_master, df_final_master)
+        else:
+            df_final_master = df_master.drop(columns=['tmp'])
+
+        # Bewaar de opgeslagen tabellen, zodat volgende stappen ze niet opnieuw hoeven in te lezen
+        st.session_state['df_products'] = df_save_products
+        st.session_state['df_master'] = df_final_master
         
         status.update(label=f"✅ Stap 1 Voltooid: {num_new} nieuwe ingrediënten toegevoegd.", state="complete")
     
     # Beknopte update aan de gebruiker
     st.success(f"**Gereed!** In totaal zijn {len(df_products)} producten verwerkt. Er zijn **{num_new}** nieuwe ingrediënten gevonden en toegevoegd aan de masterlijst voor verdere AI-analyse.")
 
-def run_ai_classifier():
-    client = get_google_sheet_client()
-    if client is None:
+def run_ai_classifier(use_batch_mode=False, batch_job=None, df_master=None):
+    """Stap 2: Masterlijst classificeren (live, via Batch Mode, of met opgehaalde batch-resultaten)"""
+    spreadsheet = open_sheet()
+    if spreadsheet is None:
+        st.cache_resource.clear()
         st.error("❌ Geen verbinding met Google Sheets.")
         return
 
@@ -142,32 +328,41 @@ def run_ai_classifier():
 
     with st.status("Stap 2: Classificeer Ingredientenlijst met AI") as status:
         st.write("🔄 Masterlijst ophalen...")
-        sheet = client.open("Eiweet validatie met AI").worksheet("Ingredienten Database")
-        df = pd.DataFrame(sheet.get_all_records())
+        sheet = spreadsheet.worksheet("Ingredienten Database")
+        df = df_master.copy() if df_master is not None else read_sheets(spreadsheet, ["Ingredienten Database"])[0]
         
         # Zoek naar rijen waar de classificatie nog leeg is
         mask = (df['Classificatie'].astype(str).str.strip() == "") | (df['Classificatie'].isna())
-        to_process = df[mask].copy()
+
+        # Ingrediënten die elders in de masterlijst al geclassificeerd zijn: antwoord overnemen zonder AI
+        ingr_key = df['Ingredient'].astype(str).str.lower().str.strip()
+        known = df.loc[~mask, ['Eiweet rol', 'Classificatie']].set_index(ingr_key[~mask])
+        known = known[~known.index.duplicated(keep='last')]
+        reuse = mask & ingr_key.isin(known.index)
+        num_reused = int(reuse.sum())
+        if num_reused:
+            df.loc[reuse, 'Eiweet rol'] = known.loc[ingr_key[reuse], 'Eiweet rol'].to_numpy()
+            df.loc[reuse, 'Classificatie'] = known.loc[ingr_key[reuse], 'Classificatie'].to_numpy()
+            df.loc[reuse, 'Classificatie datum'] = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
+            st.write(f"♻️ {num_reused} ingrediënten overgenomen van eerder geclassificeerde rijen.")
+
+        to_process = df[mask & ~reuse].copy()
         total_to_do = len(to_process)
         
         if total_to_do == 0:
+            if num_reused:
+                save_df(sheet, df)
+                st.session_state['df_master'] = df
             status.update(label="✅ Alles is al geclassificeerd!", state="complete")
             return
 
         batch_size = 30  
         st.write(f"🤖 AI analyseert {total_to_do} ingrediënten in groepen van {batch_size}...")
         
-        count_processed = 0
-        indices = to_process.index.tolist()
-
-        for i in range(0, total_to_do, batch_size):
-            batch_indices = indices[i : i + batch_size]
-            batch_num = i // batch_size + 1
-            status.write(f"⏳ Verwerken batch {batch_num}...")
-
+        def build_prompt(batch_items):
             # Prompt opbouwen
-            prompt_items = [f"ID:{idx} | Ingr:{df.at[idx, 'Ingredient']}" for idx in batch_indices]
-            prompt = f"""
+            prompt_items = [f"ID:{idx} | Ingr:{ingr}" for idx, ingr in batch_items]
+            return f"""
             Bepaal voor elk ingrediënt:
             1. Is het een bron van eiwit? (Antwoord: Wel of Niet)
             2. Wat is de oorsprong? (Antwoord: Plantaardig of Dierlijk of Niet relevant)
@@ -177,66 +372,109 @@ def run_ai_classifier():
             Lijst:
             {chr(10).join(prompt_items)}
             """
-            
+
+        def parse_response(raw_response):
+            # --- De Onverwoestbare Parser ---
+            results = []
+            for line in raw_response.split('\n'):
+                # ID, rol en oorsprong in één keer (ongevoelig voor formatting)
+                m = CLASSIFIER_RESP_RE.search(line.strip())
+                if m:
+                    oorsprong = "Niet relevant" if "relevant" in m.group(3).lower() else m.group(3).capitalize()
+                    results.append((int(m.group(1)), m.group(2).capitalize(), oorsprong))
+            return results
+
+        def process_batch(batch_items, raw_response=None):
+            """Classificeert één batch via Gemini; geeft [(idx, rol, oorsprong), ...] terug."""
+            if raw_response is not None:
+                return parse_response(raw_response)
+
+            prompt = build_prompt(batch_items)
             try:
-                raw_response = call_gemini(prompt)
-                
-                # --- De Onverwoestbare Parser ---
-                for line in raw_response.split('\n'):
-                    line = line.strip()
-                    if not line: continue
-                    
-                    # Zoek naar alle getallen in de regel (de eerste is de ID)
-                    all_numbers = re.findall(r'\d+', line)
+                results = parse_response(call_gemini(prompt, expect=CLASSIFIER_RESP_RE))
+            except ValueError:
+                results = []
+            # Onvolledig antwoord: één nieuwe poging buiten de caches om (bij dubbele ID's telt de nieuwe poging)
+            if len({r[0] for r in results}) < len(batch_items):
+                try:
+                    results += parse_response(call_gemini(prompt, expect=CLASSIFIER_RESP_RE, force_refresh=True))
+                except ValueError:
+                    if not results:
+                        raise
+            return list({r[0]: r for r in results}.values())
+
+        count_processed = 0
+        indices = to_process.index.tolist()
+        if batch_job is not None:
+            batches = batch_job["batches"]
+        else:
+            batches = [[(idx, df.at[idx, 'Ingredient']) for idx in indices[i : i + batch_size]] for i in range(0, total_to_do, batch_size)]
+
+        if use_batch_mode:
+            job_name = submit_gemini_batch("classifier", [build_prompt(b) for b in batches], batches)
+            status.update(label=f"🕓 Stap 2 ingediend als Batch-job ({job_name}). Haal de resultaten later op.", state="complete")
+            return
+        texts = batch_job["texts"] if batch_job is not None else {}
+
+        # Ingrediënt per ID zoals verstuurd; bij een Batch-job kan de sheet intussen veranderd zijn
+        sent = {idx: ingr for batch in batches for idx, ingr in batch}
+        skipped = 0
+
+        # Batches parallel naar Gemini sturen; het DataFrame wordt alleen hier (main thread) bijgewerkt
+        result_cols = ['Eiweet rol', 'Classificatie', 'Classificatie datum']
+        # Overgenomen rijen gaan mee met de eerste tussentijdse backup
+        dirty = set(df.index[reuse])
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(process_batch, batch, texts.get(f"batch_{n}")): n + 1 for n, batch in enumerate(batches)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                batch_num = futures[future]
+                checkpoint = done % 3 == 0
+                try:
+                    now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
+                    updates = {col: {} for col in result_cols}
+                    for idx, rol, oorsprong in future.result():
+                        # Match met DataFrame index, alleen als de rij nog hetzelfde ingrediënt bevat
+                        if idx not in sent or idx not in df.index or str(df.at[idx, 'Ingredient']) != str(sent[idx]):
+                            skipped += 1
+                            continue
+                        updates['Eiweet rol'][idx] = rol
+                        updates['Classificatie'][idx] = oorsprong
+                        updates['Classificatie datum'][idx] = now
+                        count_processed += 1
+                    apply_updates(df, updates)
+                    dirty.update(updates['Eiweet rol'])
                     
-                    if all_numbers:
-                        idx = int(all_numbers[0])
-                        clean_line = line.lower()
-                        
-                        # Trefwoorden zoeken (ongevoelig voor formatting)
-                        rol = ""
-                        if "wel" in clean_line: rol = "Wel"
-                        elif "niet" in clean_line: rol = "Niet"
-                        
-                        oorsprong = ""
-                        if "plantaardig" in clean_line: oorsprong = "Plantaardig"
-                        elif "dierlijk" in clean_line: oorsprong = "Dierlijk"
-                        elif "relevant" in clean_line: oorsprong = "Niet relevant"
-                        
-                        # Match met DataFrame index
-                        if idx in df.index and rol and oorsprong:
-                            df.at[idx, 'Eiweet rol'] = rol
-                            df.at[idx, 'Classificatie'] = oorsprong
-                            df.at[idx, 'Classificatie datum'] = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
-                            count_processed += 1
-                
-                status.write(f"✅ Batch {batch_num} verwerkt ({count_processed}/{total_to_do} totaal)")
+                    status.write(f"✅ Batch {batch_num} verwerkt ({count_processed}/{total_to_do} totaal)")
 
-            except Exception as e:
-                st.error(f"⚠️ Fout in batch {batch_num}: {e}")
+                except Exception as e:
+                    st.error(f"⚠️ Fout in batch {batch_num}: {e}")
+                    # Bij een fout direct tussentijds opslaan, zodat er geen werk verloren gaat
+                    checkpoint = True
 
-            # Tussentijds opslaan elke 3 batches
-            if batch_num % 3 == 0:
-                sheet.clear()
-                sheet.update(values=[df.columns.tolist()] + df.fillna("").values.tolist(), range_name='A1')
-                status.write(f"💾 Backup opgeslagen om {datetime.datetime.now().strftime('%H:%M:%S')}")
+                # Tussentijds opslaan om de 3 batches: alleen de gewijzigde rijen en kolommen
+                if checkpoint and dirty:
+                    save_cells(sheet, df, dirty, result_cols)
+                    dirty.clear()
+                    status.write(f"💾 Backup opgeslagen om {datetime.datetime.now().strftime('%H:%M:%S')}")
+
+        if skipped:
+            st.warning(f"⚠️ {skipped} antwoorden overgeslagen: de rij is gewijzigd of hoort niet bij de batch. Deze ingrediënten blijven open.")
 
-            time.sleep(0.5)
-        
         # Finale opslag
         st.write("💾 Definitieve resultaten opslaan...")
-        sheet.clear()
-        sheet.update(values=[df.columns.tolist()] + df.fillna("").values.tolist(), range_name='A1')
+        save_df(sheet, df)
+        st.session_state['df_master'] = df
         
         status.update(label=f"✅ Stap 2 Voltooid: {count_processed} items geclassificeerd.", state="complete")
     
     st.success(f"**Gereed!** De masterlijst is bijgewerkt (laatste update: {datetime.datetime.now().strftime('%H:%M')}).")
 
 
-def run_first_pass_and_review():
+def run_first_pass_and_review(use_batch_mode=False, batch_job=None, df_products=None):
     """Stap 3: Snelle Product Analyse (Batch Mode) met tijd-tracking"""
-    client = get_google_sheet_client()
-    if client is None:
+    spreadsheet = open_sheet()
+    if spreadsheet is None:
+        st.cache_resource.clear()
         st.error("❌ Geen verbinding met Google Sheets.")
         return
     
@@ -252,8 +490,8 @@ def run_first_pass_and_review():
     
     with st.status("Stap 3: Check Eiweetgroep van alle producten met AI...") as status:
         st.write("🔄 Productdata ophalen uit Google Sheets...")
-        sheet = client.open("Eiweet validatie met AI").worksheet("Producten Input")
-        df = pd.DataFrame(sheet.get_all_records())
+        sheet = spreadsheet.worksheet("Producten Input")
+        df = df_products.copy() if df_products is not None else read_sheets(spreadsheet, ["Producten Input"])[0]
 
         # Filter producten die nog een oordeel nodig hebben
         geldige_class = ['Dierlijk', 'Plantaardig', 'Combinatie']
@@ -266,14 +504,10 @@ def run_first_pass_and_review():
             batch_size = 20 
             st.write(f"🚀 Batching geactiveerd: {total_to_process} producten in groepen van {batch_size}...")
             
-            for i in range(0, total_to_process, batch_size):
-                batch_df = to_process.iloc[i : i + batch_size]
-                batch_num = i // batch_size + 1
-                status.write(f"⏳ Verwerken batch {batch_num}...")
-
+            def build_prompt(batch_items):
                 # Prompt opbouwen met expert-persona en vraag naar rationale
-                prompt_items = [f"ID:{idx} | Product:{row['Productnaam']}" for idx, row in batch_df.iterrows()]
-                prompt = f"""
+                prompt_items = [f"ID:{idx} | Product:{naam}" for idx, naam in batch_items]
+                return f"""
                 Je bent een senior voedingsmiddelenexpert gespecialiseerd in eiwitbronnen. 
                 Classificeer de volgende producten strikt als 'Plantaardig', 'Dierlijk' of 'Combinatie'.
                 Geef per product één korte zin uitleg (rationale).
@@ -289,99 +523,138 @@ def run_first_pass_and_review():
                 Producten:
                 {chr(10).join(prompt_items)}
                 """
-                
-                try:
-                    raw_response = call_gemini(prompt)
-                    # ANKE toevoeging Debug: sla ruwe AI-output op voor alle rijen in deze batch
-                    # for idx in batch_df.index:
-                    #     df.at[idx, 'Raw AI response'] = raw_response
-                    # ANKE einde toevoeging
-                    matches_in_batch = 0
-                    
-                    # De Onverwoestbare Parser met Rationale-ondersteuning
-                    # for line in raw_response.split('\n'):
-                    #     line = line.strip()
-                    #     if not line or ":" not in line:
-                    #         continue
-                        
-                     # AI-output in losse regels splitsen
-                    lines = [l.strip() for l in raw_response.split("\n") if "ID:" in l]
 
+            def parse_response(batch_items, raw_response):
+                # AI-output in losse regels splitsen
+                lines = [l.strip() for l in raw_response.split("\n") if "ID:" in l]
 
-                    for i, line in enumerate(lines):
-                        if i >= len(batch_df):
-                            break
+                results = []
+                for i, line in enumerate(lines):
+                    if i >= len(batch_items):
+                        break
+                    real_idx = batch_items[i][0]
 
-                        real_idx = batch_df.index[i]
-                        # ANKE: sla het AI-antwoord per rij op
-                        df.at[real_idx,'AI Productindeling antwoord'] = line
+                    # 2. Oordeel en rationale ophalen (oordeel None als de AI geen oordeel gaf)
+                    m = PRODUCT_RESP_RE.search(line)
+                    oordeel = m.group(1).capitalize() if m else None
+                    rationale = (m.group(2) or "").strip() if m else ""
 
-                        # 2. Oordeel ophalen
-                        oordeel_match = re.search(r'oordeel\s*[:：]\s*([A-Za-zÀ-ÿ]+)', line, re.IGNORECASE)
-                        if not oordeel_match:
-                            st.write("GEEN OORDEEL GEVONDEN IN:", line)
-                            continue
-                        oordeel = oordeel_match.group(1).capitalize()
-
-                        # 3. Rationale ophalen
-                        rationale_match = re.search(r'rationale\s*:\s*(.+)', line, re.IGNORECASE)
-                        rationale = rationale_match.group(1).strip() if rationale_match else ""
-
-                        # 4. Opslaan in DataFrame als ID bestaat en oordeel herkend is
-                        #if idx in df.index and oordeel:
-                        df.at[real_idx, 'Productindeling AI'] = oordeel
-                        df.at[real_idx, 'AI rationale'] = rationale
-                        # Timestamp met datum en tijd
-                        df.at[real_idx, 'Productindeling AI AI datum'] = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
-                        matches_in_batch += 1
-                    
-                    status.write(f"✅ Batch {batch_num} klaar: {matches_in_batch}/{len(batch_df)} producten herkend.")
-                    
-                except Exception as e:
-                    st.error(f"⚠️ Fout in batch {batch_num}: {e}")
-                    
-                # Tussentijds opslaan om de 3 batches voor maximale veiligheid
-                if batch_num % 3 == 0:
-                    # Anke vervanging om error te voorkomen:
-                    #sheet.update(values=[df.columns.tolist()] + df.where(pd.notnull(df), None).values.tolist(), range_name='A1')
-                    sheet.clear()
-                    sheet.update("A1", [df.columns.tolist()])
-                    sheet.update("A2", df.astype(str).where(pd.notnull(df), "").values.tolist())
-
-                    status.write(f"💾 Tussentijdse backup opgeslagen om {datetime.datetime.now().strftime('%H:%M:%S')}")
-
-                # Korte pauze voor API stabiliteit
-                time.sleep(0.5)
+                    results.append((real_idx, line, oordeel, rationale))
+                return results
+
+            def process_batch(batch_items, raw_response=None):
+                """Analyseert één batch producten via Gemini; geeft [(idx, regel, oordeel, rationale), ...] terug."""
+                if raw_response is not None:
+                    return parse_response(batch_items, raw_response)
+
+                prompt = build_prompt(batch_items)
+                try:
+                    results = parse_response(batch_items, call_gemini(prompt, expect=PRODUCT_RESP_RE))
+                except ValueError:
+                    results = []
+                # Niet voor elk product een oordeel: één nieuwe poging buiten de caches om, het beste antwoord telt
+                herkend = sum(r[2] is not None for r in results)
+                if herkend < len(batch_items):
+                    try:
+                        retry = parse_response(batch_items, call_gemini(prompt, expect=PRODUCT_RESP_RE, force_refresh=True))
+                    except ValueError:
+                        if not results:
+                            raise
+                    else:
+                        if sum(r[2] is not None for r in retry) > herkend:
+                            results = retry
+                return results
+
+            if batch_job is not None:
+                batches = batch_job["batches"]
+            else:
+                batches = [list(zip(to_process.index[i : i + batch_size], to_process['Productnaam'].iloc[i : i + batch_size]))
+                           for i in range(0, total_to_process, batch_size)]
+
+            if use_batch_mode:
+                job_name = submit_gemini_batch("first_pass", [build_prompt(b) for b in batches], batches)
+                status.update(label=f"🕓 Stap 3 ingediend als Batch-job ({job_name}). Haal de resultaten later op.", state="complete")
+                return
+            texts = batch_job["texts"] if batch_job is not None else {}
+
+            # Productnaam per ID zoals verstuurd; bij een Batch-job kan de sheet intussen veranderd zijn
+            sent = {idx: naam for batch in batches for idx, naam in batch}
+            skipped = 0
+
+            # Batches parallel naar Gemini sturen; het DataFrame wordt alleen hier (main thread) bijgewerkt
+            result_cols = ['AI Productindeling antwoord', 'Productindeling AI', 'AI rationale', 'Productindeling AI AI datum']
+            dirty = set()
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = {executor.submit(process_batch, batch, texts.get(f"batch_{n}")): n + 1 for n, batch in enumerate(batches)}
+                for done, future in enumerate(as_completed(futures), start=1):
+                    batch_num = futures[future]
+                    batch_len = len(batches[batch_num - 1])
+                    checkpoint = done % 3 == 0
+                    try:
+                        matches_in_batch = 0
+                        # Timestamp met datum en tijd (één per batch)
+                        now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
+                        updates = {col: {} for col in result_cols}
+                        for real_idx, line, oordeel, rationale in future.result():
+                            # Alleen terugschrijven als de rij nog hetzelfde product bevat
+                            if real_idx not in df.index or str(df.at[real_idx, 'Productnaam']) != str(sent[real_idx]):
+                                skipped += 1
+                                continue
+                            # ANKE: sla het AI-antwoord per rij op
+                            updates['AI Productindeling antwoord'][real_idx] = line
+                            if oordeel is None:
+                                st.write("GEEN OORDEEL GEVONDEN IN:", line)
+                                continue
+
+                            # 4. Opslaan in DataFrame als oordeel herkend is
+                            updates['Productindeling AI'][real_idx] = oordeel
+                            updates['AI rationale'][real_idx] = rationale
+                            updates['Productindeling AI AI datum'][real_idx] = now
+                            matches_in_batch += 1
+                        apply_updates(df, updates)
+                        dirty.update(updates['AI Productindeling antwoord'])
+                        
+                        status.write(f"✅ Batch {batch_num} klaar: {matches_in_batch}/{batch_len} producten herkend.")
+                        
+                    except Exception as e:
+                        st.error(f"⚠️ Fout in batch {batch_num}: {e}")
+                        # Bij een fout direct tussentijds opslaan, zodat er geen werk verloren gaat
+                        checkpoint = True
+
+                    # Tussentijds opslaan om de 3 batches: alleen de gewijzigde rijen en kolommen
+                    if checkpoint and dirty:
+                        save_cells(sheet, df, dirty, result_cols)
+                        dirty.clear()
+                        status.write(f"💾 Tussentijdse backup opgeslagen om {datetime.datetime.now().strftime('%H:%M:%S')}")
+
+            if skipped:
+                st.warning(f"⚠️ {skipped} antwoorden overgeslagen: de rij bevat inmiddels een ander product. Deze producten blijven open.")
         else:
             st.write("✅ Alle producten zijn al voorzien van een 'Productindeling AI' label.")
 
         # --- B. STANDAARDISATIE & VERGELIJKING ---
         st.write("📊 Vergelijken met supermarkt labels...")
         
-        def standardize(val):
-            val = str(val).lower()
-            if 'combi' in val: return 'Combinatie'
-            if 'plantaardig' in val: return 'Plantaardig'
-            if 'dierlijk' in val: return 'Dierlijk'
-            return 'Onbekend'
-
-        df['Gestandaardiseerd supermarkt label'] = df['Eiweetgroep Supermarkt'].apply(standardize)
+        # Supermarkt-label terugbrengen tot Combinatie / Plantaardig / Dierlijk / Onbekend
+        val = df['Eiweetgroep Supermarkt'].astype(str).str.lower()
+        df['Gestandaardiseerd supermarkt label'] = np.select(
+            [val.str.contains('combi', regex=False, na=False),
+             val.str.contains('plantaardig', regex=False, na=False),
+             val.str.contains('dierlijk', regex=False, na=False)],
+            ['Combinatie', 'Plantaardig', 'Dierlijk'], default='Onbekend'
+        )
         
-        def determine_review(row):
-            ai_val = str(row['Productindeling AI']).strip()
-            supermarkt_val = str(row['Gestandaardiseerd supermarkt label']).strip()
-            if ai_val == "" or supermarkt_val == "Onbekend":
-                return "ja"
-            return "nee" if ai_val == supermarkt_val else "ja"
-
-        df['Review nodig'] = df.apply(determine_review, axis=1)
+        # Review nodig als de AI geen oordeel heeft, het supermarkt-label onbekend is of ze verschillen
+        ai_val = df['Productindeling AI'].astype(str).str.strip()
+        supermarkt_val = df['Gestandaardiseerd supermarkt label'].astype(str).str.strip()
+        df['Review nodig'] = np.where((ai_val == "") | (supermarkt_val == "Onbekend") | (ai_val != supermarkt_val), "ja", "nee")
         
         num_reviews = len(df[df['Review nodig'] == "ja"])
 
         # Finale opslag
         st.write("💾 Definitieve resultaten opslaan...")
-        sheet.clear()
-        sheet.update(values=[df.columns.tolist()] + df.where(pd.notnull(df), None).values.tolist(), range_name='A1')
+        save_df(sheet, df)
+        st.session_state['df_products'] = df
         
         status.update(label=f"✅ Stap 3 Voltooid! {num_reviews} reviews gemarkeerd.", state="complete")
     
@@ -392,90 +665,81 @@ def run_first_pass_and_review():
         st.success("**Gereed!** De AI is het volledig eens met de supermarkt labels.")
         current_time_str = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
 
-def run_ingredient_logic():
+def run_ingredient_logic(df_products=None, df_master=None):
     """Stap 4: Diepe analyse op basis van de ingrediënten-masterlijst"""
-    client = get_google_sheet_client()
-    if client is None:
+    ss = open_sheet()
+    if ss is None:
+        st.cache_resource.clear()
         st.error("❌ Geen verbinding met Google Sheets.")
         return
 
     with st.status("Stap 4: Ingrediënten-check per product...") as status:
         st.write("🔄 Data ophalen uit beide tabbladen...")
-        ss = client.open("Eiweet validatie met AI")
         
         # Haal de masterlijst en de producten op
-        df_master = pd.DataFrame(ss.worksheet("Ingredienten Database").get_all_records())
         sheet_p = ss.worksheet("Producten Input")
-        df_p = pd.DataFrame(sheet_p.get_all_records())
-
-        # Maak een 'opzoekboek' (dictionary) van de masterlijst voor snelheid
-        # Formaat: { 'melk': ('wel', 'dierlijk'), 'water': ('niet', 'n.v.t.') }
-        m_dict = {
-            str(r['Ingredient']).lower().strip(): (str(r['Eiweet rol']).lower().strip(), str(r['Classificatie']).lower().strip()) 
-            for _, r in df_master.iterrows()
-        }
+        if df_products is not None and df_master is not None:
+            df_p = df_products.copy()
+        else:
+            df_master, df_p = read_sheets(ss, ["Ingredienten Database", "Producten Input"])
+
+        # Maak een 'opzoekboek' van de masterlijst (bij dubbele ingrediënten telt de laatste)
+        # Formaat: token='melk', rol='wel', cl='dierlijk'
+        df_m = pd.DataFrame({
+            'token': df_master['Ingredient'].astype(str).str.lower().str.strip(),
+            'rol': df_master['Eiweet rol'].astype(str).str.lower().str.strip(),
+            'cl': df_master['Classificatie'].astype(str).str.lower().str.strip(),
+        }).drop_duplicates('token', keep='last')
+
+        # Alleen eiwitbronnen met een bekende oorsprong zijn relevant voor de koppeling
+        df_m['soort'] = np.select(
+            [df_m['cl'].str.contains('plantaardig', regex=False), df_m['cl'].str.contains('dierlijk', regex=False)],
+            ['plant', 'dier'], default=''
+        )
+        df_m = df_m.loc[(df_m['rol'] == 'wel') & (df_m['soort'] != ''), ['token', 'soort']]
 
         st.write(f"🔬 Analyse van {len(df_p)} producten op ingrediënt-niveau...")
 
-        for idx, row in df_p.iterrows():
-            clean_text = str(row['Ingredients clean']).lower()
-            ingrs = [x.strip() for x in re.split(r"[ ,]", clean_text) if len(x.strip()) > 2]
-            
-            found_plant = []
-            found_dier = []
-            
-            for i in ingrs:
-                if i in m_dict:
-                    rol, cl = m_dict[i]
-                    if rol == 'wel':
-                        if 'plantaardig' in cl:
-                            found_plant.append(i.capitalize())
-                        elif 'dierlijk' in cl:
-                            found_dier.append(i.capitalize())
-            
-            found_plant = list(set(found_plant))
-            found_dier = list(set(found_dier))
-            all_wel = found_plant + found_dier
-            
-            # --- DE CRUCIALE STAP: Alleen verwerken bij een match ---
-            if all_wel:
-                if found_plant and found_dier:
-                    cat = "Combinatie"
-                    ingredientrationale = f"{found_plant[0]} is plantaardig en {found_dier[0]} is dierlijk."
-                elif found_plant:
-                    cat = "Plantaardig"
-                    ingredientrationale = f"Bevat plantaardige bron(nen): {', '.join(found_plant)}."
-                elif found_dier:
-                    cat = "Dierlijk"
-                    ingredientrationale = f"Bevat dierlijke bron(nen): {', '.join(found_dier)}."
-                else:
-                    cat = "Onbekend"
-                    ingredientrationale = "Eiwitbronnen gevonden maar type onbekend."
-
-                # Update alleen deze specifieke velden in het DataFrame
-                df_p.at[idx, 'Ingredienten gebaseerde eiweet groep'] = cat
-                df_p.at[idx, 'Eiwitbronnen'] = ", ".join(all_wel)
-                df_p.at[idx, 'AI ingredientrationale'] = ingredientrationale
+        # Unieke (product, ingrediënt)-paren, in één keer gekoppeld aan de relevante masterlijst
+        tokens = df_p['Ingredients clean'].fillna("").astype(str).str.lower().str.replace(",", " ", regex=False).str.split().explode()
+        tokens = tokens[tokens.str.len() > 2].rename('token').rename_axis('idx').reset_index().drop_duplicates()
+        hits = tokens.merge(df_m, on='token')
+        hits['naam'] = hits['token'].str.capitalize()
+
+        # Per product de gevonden plantaardige en dierlijke bronnen (gesorteerd, dus deterministisch)
+        found = hits.sort_values('naam').groupby(['idx', 'soort'])['naam'].agg(list).unstack().reindex(columns=['plant', 'dier']).astype(object)
+
+        # --- DE CRUCIALE STAP: Alleen verwerken bij een match ---
+        if not found.empty:
+            has_plant, has_dier = found['plant'].notna(), found['dier'].notna()
+            plant_str, dier_str = found['plant'].str.join(", "), found['dier'].str.join(", ")
+            cat = np.select([has_plant & has_dier, has_plant, has_dier], ["Combinatie", "Plantaardig", "Dierlijk"], default="Onbekend")
+            ingredientrationale = np.select(
+                [has_plant & has_dier, has_plant, has_dier],
+                [found['plant'].str[0] + " is plantaardig en " + found['dier'].str[0] + " is dierlijk.",
+                 "Bevat plantaardige bron(nen): " + plant_str + ".",
+                 "Bevat dierlijke bron(nen): " + dier_str + "."],
+                default="Eiwitbronnen gevonden maar type onbekend."
+            )
+
+            # Update alleen deze specifieke velden in het DataFrame
+            df_p.loc[found.index, 'Ingredienten gebaseerde eiweet groep'] = cat
+            df_p.loc[found.index, 'Eiwitbronnen'] = (plant_str.fillna("") + ", " + dier_str.fillna("")).str.strip(", ")
+            df_p.loc[found.index, 'AI ingredientrationale'] = ingredientrationale
 
         # Update de 'Handmatige review nodig' vlag
         # We vlaggen het product als de supermarkt-label afwijkt van BEIDE AI-checks
-        def final_review_check(row):
-            sm_label = str(row['Gestandaardiseerd supermarkt label'])
-            ai_first = str(row['Productindeling AI'])
-            ingr_label = str(row['Ingredienten gebaseerde eiweet groep'])
-            
-            if sm_label != ai_first and sm_label != ingr_label:
-                return "Ja"
-            return "Nee"
-
-        df_p['Handmatige review nodig'] = df_p.apply(final_review_check, axis=1)
+        sm_label = df_p['Gestandaardiseerd supermarkt label'].astype(str)
+        ai_first = df_p['Productindeling AI'].astype(str)
+        ingr_label = df_p['Ingredienten gebaseerde eiweet groep'].astype(str)
+        df_p['Handmatige review nodig'] = np.where((sm_label != ai_first) & (sm_label != ingr_label), "Ja", "Nee")
 
         # Tellers voor rapportage
         num_review_final = len(df_p[df_p['Handmatige review nodig'] == "Ja"])
         
         st.write("💾 Resultaten opslaan in Google Sheets...")
-        sheet_p.clear()
-        sheet_p.update(values=[df_p.columns.tolist()] + df_p.where(pd.notnull(df_p), None).values.tolist(), range_name='A1')
+        save_df(sheet_p, df_p)
+        st.session_state['df_products'] = df_p
         
         status.update(label=f"✅ Stap 4 Voltooid. {num_review_final} producten vallen buiten de boot.", state="complete")
 
@@ -487,19 +751,19 @@ def run_ingredient_logic():
 
 def run_reports():
     """Stap 5: Genereer Vendor Rapporten per supermarkt"""
-    client = get_google_sheet_client()
-    if client is None:
+    ss = open_sheet()
+    if ss is None:
+        st.cache_resource.clear()
         st.error("❌ Geen verbinding met Google Sheets.")
         return
 
     with st.status("Stap 5: Rapporten per supermarkt genereren...") as status:
         st.write("🔄 Hoofdtabel inladen...")
-        ss = client.open("Eiweet validatie met AI")
-        sheet_p = ss.worksheet("Producten Input")
-        df = pd.DataFrame(sheet_p.get_all_records())
+        df, = read_sheets(ss, ["Producten Input"], use_cache=True)
         
-        # Haal alle unieke supermarkten op (en negeer lege cellen)
-        vendors = [v for v in df['Supermarkt'].unique() if v and str(v).strip() != ""]
+        # Producten in één pass per supermarkt groeperen (lege cellen negeren, volgorde van de sheet aanhouden)
+        groups = {v: df_v for v, df_v in df.groupby('Supermarkt', sort=False) if v and str(v).strip() != ""}
+        vendors = list(groups)
         total_vendors = len(vendors)
         
         if total_vendors == 0:
@@ -508,41 +772,85 @@ def run_reports():
 
         st.write(f"📊 Er worden rapporten gemaakt voor {total_vendors} supermarkten...")
 
-        for i, v in enumerate(vendors):
-            status.write(f"Bezig met {i+1}/{total_vendors}: **{v}**")
-            
-            # Filter de data voor deze specifieke supermarkt
-            df_v = df[df['Supermarkt'] == v].copy()
-            
-            # Maak een geldige naam voor het tabblad (max 31 tekens, geen verboden tekens)
-            tab_name = f"Rapport_{str(v).replace(' ', '_')}"[:31]
-            
-            try:
-                # Probeer het tabblad te openen, anders maak het aan
-                try:
-                    ws = ss.worksheet(tab_name)
-                except gspread.exceptions.WorksheetNotFound:
-                    ws = ss.add_worksheet(title=tab_name, rows="1000", cols="20")
-                
-                # Schrijf de gefilterde data naar het tabblad
-                ws.clear()
-                # We vullen lege waarden (NaN) in met een lege string om fouten te voorkomen
-                data_to_save = [df_v.columns.tolist()] + df_v.fillna("").values.tolist()
-                ws.update(values=data_to_save, range_name='A1')
-                
-            except Exception as e:
-                st.error(f"Fout bij maken van rapport voor {v}: {e}")
-                continue
-        
+        # Bestaande tabbladen (titel -> sheetId) in één keer ophalen; Sheets vergelijkt namen hoofdletterongevoelig
+        existing = {sh['properties']['title'].lower(): (sh['properties']['title'], sh['properties']['sheetId'])
+                    for sh in ss.fetch_sheet_metadata()['sheets']}
+
+        # Maak een geldige, unieke naam voor het tabblad (max 31 tekens, geen verboden tekens)
+        # Supermarkten die op dezelfde naam uitkomen krijgen een volgnummer, anders faalt het hele request
+        tab_names, used = {}, set()
+        for v in vendors:
+            base = f"Rapport_{str(v).replace(' ', '_')}"[:31]
+            name, n = base, 1
+            while name.lower() in used:
+                n += 1
+                name = f"{base[:30 - len(str(n))]}_{n}"
+            used.add(name.lower())
+            tab_names[v] = existing.get(name.lower(), (name,))[0]
+
+        try:
+            # Rapport per supermarkt opbouwen
+            data = {}
+            for i, (v, df_v) in enumerate(groups.items()):
+                status.write(f"Bezig met {i+1}/{total_vendors}: **{v}**")
+                data[tab_names[v]] = sheet_payload(tab_names[v], df_v)
+
+            # Ontbrekende tabbladen aanmaken en bestaande leegmaken, samen in één request
+            # Het raster is minstens zo groot als het rapport (standaard 1000 x 20, zoals voorheen)
+            sheet_requests = []
+            for t, payload in data.items():
+                grid = {'rowCount': max(len(payload['values']), 1000), 'columnCount': max(len(payload['values'][0]), 20)}
+                if t.lower() in existing:
+                    sheet_id = existing[t.lower()][1]
+                    sheet_requests.append({'updateCells': {'range': {'sheetId': sheet_id}, 'fields': 'userEnteredValue'}})
+                    sheet_requests.append({'updateSheetProperties': {
+                        'properties': {'sheetId': sheet_id, 'gridProperties': grid},
+                        'fields': 'gridProperties(rowCount,columnCount)'
+                    }})
+                else:
+                    sheet_requests.append({'addSheet': {'properties': {'title': t, 'gridProperties': grid}}})
+            ss.batch_update({'requests': sheet_requests})
+
+            # Alle rapporten in één request wegschrijven
+            ss.values_batch_update({'valueInputOption': 'RAW', 'data': list(data.values())})
+
+        except Exception as e:
+            st.error(f"Fout bij maken van de rapporten: {e}")
+            status.update(label="❌ Stap 5 mislukt: de rapporten zijn niet bijgewerkt.", state="error")
+            return
+
         status.update(label=f"✅ Klaar! {total_vendors} rapporten zijn bijgewerkt.", state="complete")
 
     # Eindrapportage
     st.success(f"**Alle rapporten zijn gegenereerd!** Je vindt nu voor elke supermarkt ({', '.join(vendors)}) een apart tabblad in je Google Sheet met de specifieke resultaten.")
 
+def run_batch_results(stage):
+    """Haalt de resultaten van een eerder ingediende Batch-job op en verwerkt ze"""
+    state, texts = fetch_gemini_batch(stage)
+    if texts is None:
+        if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            st.error(f"❌ Batch-job is afgebroken (status: {state}). Dien de stap opnieuw in.")
+            del st.session_state["batch_jobs"][stage]
+        else:
+            st.info(f"🕓 Batch-job is nog niet klaar (status: {state}). Probeer het later opnieuw.")
+        return
+
+    # Resultaten door de bestaande parser en opslag-logica van de stap halen
+    job = st.session_state["batch_jobs"].pop(stage)
+    batch_job = {"batches": job["batches"], "texts": texts}
+    if stage == "classifier":
+        run_ai_classifier(batch_job=batch_job)
+    else:
+        run_first_pass_and_review(batch_job=batch_job)
+
 def run_full_pipeline():
     """Voert Stap 1 t/m 5 automatisch achter elkaar uit"""
     st.header("🚀 Volledige Pijplijn Starten")
     
+    # Tabellen worden tussen de stappen via de sessie doorgegeven; begin zonder oude resultaten
+    st.session_state.pop('df_products', None)
+    st.session_state.pop('df_master', None)
+
     # We maken een grote container voor de voortgang
     with st.container(border=True):
         st.subheader("Voortgang van alle stappen")
@@ -554,17 +862,17 @@ def run_full_pipeline():
         # Stap 2: AI Masterlijst Classificatie
         st.markdown("---")
         st.markdown("### 2️⃣ Masterlijst classificeren met AI")
-        run_ai_classifier()
+        run_ai_classifier(df_master=st.session_state.get('df_master'))
         
         # Stap 3 & 4: Productindeling AI & Review markering
         st.markdown("---")
         st.markdown("### 3️⃣ & 4️⃣ Product Analyse & Review check")
-        run_first_pass_and_review()
+        run_first_pass_and_review(df_products=st.session_state.get('df_products'))
         
         # Stap 5: Diepe Ingrediënten Logica
         st.markdown("---")
         st.markdown("### 5️⃣ Diepe Ingrediënten-check (Feit-check)")
-        run_ingredient_logic()
+        run_ingredient_logic(df_products=st.session_state.get('df_products'), df_master=st.session_state.get('df_master'))
 
     st.success("🎉 De volledige pijplijn is succesvol voltooid! Je Google Sheet is nu volledig up-to-date.")
 
@@ -582,15 +890,24 @@ def main():
     2. **Workflow:** Doorloop altijd de stappen **1 t/m 5** in deze volgorde.
     """)
 
+    # Batch Mode: stap 2 en 3 worden als Gemini Batch-job ingediend (50% goedkoper, klaar binnen 24 uur)
+    use_batch_mode = st.toggle("🐢 Gemini Batch Mode voor stap 2 en 3 (goedkoper, resultaten later ophalen)")
+
     # Stappen 1 t/m 5 onder elkaar, volledige breedte, dezelfde kleur
     if st.button("1️⃣ Prep Ingrediëntenlijst", use_container_width=True): 
         run_prep_ingredients()
         
     if st.button("2️⃣ AI Classificatie Masterlijst", use_container_width=True): 
-        run_ai_classifier()
+        run_ai_classifier(use_batch_mode=use_batch_mode)
         
     if st.button("3️⃣ AI Product Analyse", use_container_width=True): 
-        run_first_pass_and_review()
+        run_first_pass_and_review(use_batch_mode=use_batch_mode)
+
+    # Openstaande Batch-jobs: knop om de resultaten op te halen
+    stage_labels = {"classifier": "2️⃣ Stap 2", "first_pass": "3️⃣ Stap 3"}
+    for stage in list(st.session_state.get("batch_jobs", {})):
+        if st.button(f"📥 Check resultaten Batch-job {stage_labels[stage]}", use_container_width=True):
+            run_batch_results(stage)
         
     if st.button("4️⃣ Diepe Ingrediënten-check", use_container_width=True): 
         run_ingredient_logic()